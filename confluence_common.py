@@ -0,0 +1,347 @@
+"""
+Confluence access, HTML cleanup, image description and bulk indexing shared by
+confluence_ingest.py and confluence_sync.py.
+
+Requires environment variables:
+- CONFLUENCE_BASE
+- CONFLUENCE_PAT
+- OPENAI_API_KEY
+- OPENSEARCH_HOST (optional)
+- IMAGE_CACHE_DB (optional, sqlite path for cached image descriptions; point it at a
+  persistent volume, the default is relative to the working directory)
+"""
+import os, io, re, html as html_lib, base64, hashlib, sqlite3, threading, requests, asyncio
+import orjson
+from PIL import Image, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin
+from selectolax.lexbor import LexborHTMLParser
+from opensearchpy import OpenSearch, helpers
+import openai
+
+from embedding import INDEX, INDEX_BODY, chunk_text, embed_chunks
+
+# --- ENV VARS ---
+CONFLUENCE_BASE_RAW = os.getenv("CONFLUENCE_BASE", "").strip()
+CONFLUENCE_PAT = os.getenv("CONFLUENCE_PAT")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENSEARCH = os.getenv("OPENSEARCH_HOST", "http://localhost:9200")
+
+if not CONFLUENCE_BASE_RAW:
+    raise SystemExit("CONFLUENCE_BASE env var required")
+CONFLUENCE_BASE = CONFLUENCE_BASE_RAW.rstrip("/")
+
+if not CONFLUENCE_PAT:
+    raise SystemExit("CONFLUENCE_PAT env var required")
+
+headers = {"Authorization": f"Bearer {CONFLUENCE_PAT}", "Accept": "application/json", "Accept-Encoding": "gzip"}
+MAX_WORKERS = 16
+IMAGE_CONCURRENCY = 8
+MAX_IMAGE_DIM = 1024
+MIN_IMAGE_DIM = 64  # anything smaller is an icon
+MAX_IMAGE_BYTES = 20 * 1024 * 1024  # larger downloads are abandoned, not described
+IMAGE_CACHE_DB = os.getenv("IMAGE_CACHE_DB", "img_cache.db")
+
+# shared keep-alive session; 32 per host covers MAX_WORKERS page threads plus IMAGE_CONCURRENCY image downloads
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
+openai.api_key = OPENAI_API_KEY
+
+# image descriptions keyed by sha256 of the image bytes, shared across runs
+_cache_lock = threading.Lock()
+# _cache_lock only serializes this process; parallel Airflow tasks sharing the file wait on
+# sqlite's own lock (timeout) and WAL lets readers proceed while another process writes
+_cache_db = sqlite3.connect(IMAGE_CACHE_DB, check_same_thread=False, timeout=30)
+_cache_db.execute("PRAGMA journal_mode=WAL")
+_cache_db.execute("CREATE TABLE IF NOT EXISTS cache (sha TEXT PRIMARY KEY, description TEXT)")
+
+# per-run dedup of images shared across pages
+_dedup_lock = threading.Lock()
+_image_desc_by_url = {}
+
+os_client = OpenSearch(OPENSEARCH, http_compress=True)
+
+# every page thread submits to one event loop, so IMAGE_CONCURRENCY is a process-wide limit;
+# started on first use so processes that never describe images don't spawn the thread
+_image_loop = None
+_image_loop_lock = threading.Lock()
+_image_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5) if OPENAI_API_KEY else None
+_image_sem = asyncio.Semaphore(IMAGE_CONCURRENCY)
+
+
+# --- HTML ---
+# storage-format code/noformat macros keep their body in CDATA, which HTML parsers drop
+_CDATA_RE = re.compile(r"<!\[CDATA\[(.*?)\]\]>", re.S)
+
+
+def parse_html(html):
+    """Parse storage-format XHTML with selectolax, keeping CDATA sections as text."""
+    html = _CDATA_RE.sub(lambda m: html_lib.escape(m.group(1), quote=False), html or "")
+    return LexborHTMLParser(html)
+
+
+def html_to_text(html):
+    return parse_html(html).text(separator=" ", strip=True)
+
+
+# --- FETCH HELPERS ---
+def fetch_spaces(limit=50, start=0):
+    url = f"{CONFLUENCE_BASE}/rest/api/space"
+    params = {"limit": limit, "start": start}
+    r = SESSION.get(url, headers=headers, params=params, timeout=30)
+    r.raise_for_status()
+    return orjson.loads(r.content)
+
+
+def fetch_attachments_for_page(page_id, limit=50):
+    url = f"{CONFLUENCE_BASE}/rest/api/content/{page_id}/child/attachment"
+    params = {"limit": limit, "expand": "history"}
+    r = SESSION.get(url, headers=headers, params=params, timeout=30)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("results", [])
+
+
+def fetch_comments_for_page(page_id, limit=50, start=0):
+    url = f"{CONFLUENCE_BASE}/rest/api/content/{page_id}/child/comment"
+    params = {"limit": limit, "start": start, "expand": "body.storage"}
+    r = SESSION.get(url, headers=headers, params=params, timeout=30)
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    comments = []
+    for c in data.get("results", []):
+        body = c.get("body", {}).get("storage", {}).get("value", "")
+        comments.append(html_to_text(body))
+    return comments
+
+
+# --- IMAGE DESCRIPTION ---
+def get_cached_description(sha):
+    try:
+        with _cache_lock:
+            row = _cache_db.execute("SELECT description FROM cache WHERE sha = ?", (sha,)).fetchone()
+    except sqlite3.Error as e:
+        print(f"Image cache read failed: {e}")
+        return None
+    return row[0] if row else None
+
+
+def cache_description(sha, description):
+    with _cache_lock, _cache_db:
+        _cache_db.execute("INSERT OR REPLACE INTO cache (sha, description) VALUES (?, ?)", (sha, description))
+
+
+def is_image_attachment(attachment):
+    media_type = (
+        attachment.get("metadata", {}).get("mediaType")
+        or attachment.get("extensions", {}).get("mediaType")
+        or ""
+    )
+    return media_type.startswith("image/")
+
+
+def fetch_image_bytes(image_url):
+    """Stream the image; returns None once it grows past MAX_IMAGE_BYTES."""
+    # only Confluence gets the PAT; externally hosted images are fetched anonymously
+    is_confluence = image_url.startswith(CONFLUENCE_BASE + "/")
+    with SESSION.get(image_url, headers=headers if is_confluence else None, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        if int(r.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+            return None
+        content = bytearray()
+        for block in r.iter_content(64 * 1024):
+            content += block
+            if len(content) > MAX_IMAGE_BYTES:
+                return None
+    return bytes(content)
+
+
+def prepare_image_payload(content):
+    """Downscale image bytes; returns (data_url, detail) or None for icons/non-images."""
+    try:
+        img = Image.open(io.BytesIO(content))
+        img.load()
+    except (UnidentifiedImageError, OSError):
+        return None
+    w, h = img.size
+    if max(w, h) < MIN_IMAGE_DIM:
+        return None
+    # very wide/tall images are usually text screenshots; keep them legible
+    detail = "high" if max(w, h) / min(w, h) > 2.5 else "low"
+    img.thumbnail((MAX_IMAGE_DIM, MAX_IMAGE_DIM), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=80)
+    b64 = base64.b64encode(buf.getvalue()).decode()
+    return f"data:image/jpeg;base64,{b64}", detail
+
+
+async def describe_image_via_openai(client, sem, image_url):
+    """Returns the description, or None when the image is skipped."""
+    async with sem:
+        try:
+            content = await asyncio.to_thread(fetch_image_bytes, image_url)
+            if content is None:
+                return None
+            sha = hashlib.sha256(content).hexdigest()
+            cached = await asyncio.to_thread(get_cached_description, sha)
+            if cached is not None:
+                return cached
+            payload = await asyncio.to_thread(prepare_image_payload, content)
+            if payload is None:
+                return None
+            data_url, detail = payload
+            resp = await client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": "Describe this image in detail, including objects, text, charts, and labels."},
+                        {"type": "image_url", "image_url": {"url": data_url, "detail": detail}}
+                    ]
+                }]
+            )
+            desc = resp.choices[0].message.content.strip()
+        except Exception as e:
+            return f"[image description failed: {str(e)}]"
+    # a cache failure must not discard a description that was already paid for
+    try:
+        await asyncio.to_thread(cache_description, sha, desc)
+    except sqlite3.Error as e:
+        print(f"Image cache write failed: {e}")
+    return desc
+
+
+def _get_image_loop():
+    global _image_loop
+    with _image_loop_lock:
+        if _image_loop is None:
+            _image_loop = asyncio.new_event_loop()
+            threading.Thread(target=_image_loop.run_forever, name="image-describe", daemon=True).start()
+    return _image_loop
+
+
+async def _describe_images(image_urls):
+    return await asyncio.gather(*(describe_image_via_openai(_image_client, _image_sem, u) for u in image_urls))
+
+
+def describe_images(image_urls):
+    """Describe a batch of images concurrently; results are in input order (None = skipped)."""
+    if not image_urls:
+        return []
+    if not OPENAI_API_KEY:
+        return ["[openai key not set — image not described]"] * len(image_urls)
+    # shared attachments/logos repeat across pages; describe each URL once per run
+    with _dedup_lock:
+        todo = list(dict.fromkeys(u for u in image_urls if u not in _image_desc_by_url))
+    if todo:
+        descs = asyncio.run_coroutine_threadsafe(_describe_images(todo), _get_image_loop()).result()
+        with _dedup_lock:
+            _image_desc_by_url.update(zip(todo, descs))
+    with _dedup_lock:
+        return [_image_desc_by_url[u] for u in image_urls]
+
+
+def clean_html_and_describe_images(html, page_id):
+    tree = parse_html(html)
+    img_tags = tree.css("img")
+    urls = []
+    for img in img_tags:
+        src = img.attributes.get("src") or img.attributes.get("data-src") or ""
+        urls.append(src if src.startswith("http") else urljoin(CONFLUENCE_BASE + "/", src.lstrip("/")))
+    try:
+        attachments = fetch_attachments_for_page(page_id)
+    except Exception:
+        attachments = []
+    for a in attachments:
+        rel = a.get("_links", {}).get("download")
+        if rel and is_image_attachment(a):
+            urls.append(urljoin(CONFLUENCE_BASE + "/", rel.lstrip("/")))
+    descs = describe_images(urls)
+    images = [{"url": u, "description": d} for u, d in zip(urls, descs) if d is not None]
+    for img, desc in zip(img_tags, descs):
+        if desc is None:
+            img.decompose()
+        else:
+            img.replace_with(f"[Image description: {desc}]")
+    text = tree.text(separator=" ", strip=True)
+    return text, images
+
+
+# --- INDEXING ---
+def ensure_index():
+    """Create the index with ingest-friendly settings; refuse an existing index with an older mapping."""
+    os_client.indices.create(index=INDEX, body=INDEX_BODY, ignore=400)
+    mapping = next(iter(os_client.indices.get_mapping(index=INDEX).values()))
+    field = mapping["mappings"].get("properties", {}).get("embedding", {})
+    if field.get("type") != "knn_vector" or field.get("data_type") != "byte":
+        raise SystemExit(
+            f"Index '{INDEX}' has an outdated 'embedding' mapping ({field or 'missing'}); expected a byte knn_vector. "
+            f"Delete it (curl -X DELETE $OPENSEARCH_HOST/{INDEX}) and re-run confluence_ingest.py, see README.md."
+        )
+
+
+def build_chunk_doc(title, url, space, page_id, chunk_idx, text, emb, images, comments):
+    return {
+        "title": title,
+        "url": url,
+        "text": text,
+        "metadata": {"space": space, "page_id": page_id, "chunk": chunk_idx},
+        "embedding": emb.tolist(),
+        "images": images,
+        "comments": comments or []
+    }
+
+
+def process_page(page, space_key):
+    """Fetch everything a page needs (images, attachments, comments) and split it into chunks."""
+    page_id = page.get("id")
+    title = page.get("title")
+    url = urljoin(CONFLUENCE_BASE + "/", page.get("_links", {}).get("webui", "").lstrip("/"))
+    html = page.get("body", {}).get("storage", {}).get("value", "")
+    text, images = clean_html_and_describe_images(html, page_id)
+    comments = fetch_comments_for_page(page_id)
+    chunks = chunk_text(text)
+    return [((title, url, space_key, page_id, i), ch, images, comments) for i, ch in enumerate(chunks)]
+
+
+def index_chunks(pending):
+    """Embed process_page() output and bulk-index it; call from one thread, encode() is not thread-safe.
+
+    Returns the failed bulk actions.
+    """
+    if not pending:
+        return []
+    embs = embed_chunks([ch for _, ch, _, _ in pending])
+    return bulk_index(
+        {
+            "_op_type": "index",
+            "_index": INDEX,
+            "_id": f"{page_id}-{i}",
+            "_source": build_chunk_doc(title, url, space, page_id, i, ch, emb, images, comments),
+        }
+        for ((title, url, space, page_id, i), ch, images, comments), emb in zip(pending, embs)
+    )
+
+
+def bulk_index(actions):
+    """Send index actions through the bulk API; 429s are retried with backoff. Returns the failed actions."""
+    _, errors = helpers.bulk(
+        os_client,
+        actions,
+        chunk_size=500,
+        max_chunk_bytes=100 * 1024 * 1024,
+        request_timeout=120,
+        max_retries=3,
+        initial_backoff=2,
+        raise_on_error=False,
+    )
+    if errors:
+        print(f"Bulk indexing: {len(errors)} failed action(s), first: {errors[0]}")
+    return errors
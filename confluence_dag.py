@@ -1,6 +1,15 @@
+import os
+import sys
 from airflow import DAG
-from airflow.operators.bash import BashOperator
-from datetime import datetime, timedelta
+from airflow.decorators import task, task_group
+from airflow.models import Variable
+from datetime import datetime, timedelta, timezone
+
+APP_DIR = "/app"
+MAX_SPACES = 10
+# caps concurrent Confluence API load across mapped tasks; create it first, e.g.
+#   airflow pools set confluence_api 4 "Confluence REST API"
+CONFLUENCE_POOL = "confluence_api"
 
 default_args = {
     "owner": "airflow",
@@ -9,6 +18,19 @@ default_args = {
     "retry_delay": timedelta(minutes=5),
 }
 
+
+def load_app_env():
+    """The ingest/sync modules read their config at import time, so set it before importing."""
+    for name in ("CONFLUENCE_BASE", "CONFLUENCE_PAT", "OPENAI_API_KEY", "OPENSEARCH_HOST"):
+        os.environ[name] = Variable.get(name)
+    # optional; should point at storage shared by the workers so descriptions outlive the task
+    image_cache_db = Variable.get("IMAGE_CACHE_DB", default_var=None)
+    if image_cache_db:
+        os.environ["IMAGE_CACHE_DB"] = image_cache_db
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+
 with DAG(
     dag_id="confluence_to_opensearch",
     default_args=default_args,
@@ -18,26 +40,68 @@ with DAG(
     catchup=False,
 ) as dag:
 
-    ingest = BashOperator(
-        task_id="full_ingest",
-        bash_command="python /app/confluence_ingest.py",
-        env={
-            "CONFLUENCE_BASE": "{{ var.value.CONFLUENCE_BASE }}",
-            "CONFLUENCE_PAT": "{{ var.value.CONFLUENCE_PAT }}",
-            "OPENAI_API_KEY": "{{ var.value.OPENAI_API_KEY }}",
-            "OPENSEARCH_HOST": "{{ var.value.OPENSEARCH_HOST }}"
-        }
-    )
-
-    sync = BashOperator(
-        task_id="incremental_sync",
-        bash_command="python /app/confluence_sync.py",
-        env={
-            "CONFLUENCE_BASE": "{{ var.value.CONFLUENCE_BASE }}",
-            "CONFLUENCE_PAT": "{{ var.value.CONFLUENCE_PAT }}",
-            "OPENAI_API_KEY": "{{ var.value.OPENAI_API_KEY }}",
-            "OPENSEARCH_HOST": "{{ var.value.OPENSEARCH_HOST }}"
-        }
-    )
-
-    ingest >> sync
+    @task
+    def list_spaces(max_spaces=MAX_SPACES):
+        load_app_env()
+        import confluence_ingest
+
+        keys = []
+        start = 0
+        while len(keys) < max_spaces:
+            results = confluence_ingest.fetch_spaces(limit=25, start=start).get("results", [])
+            keys.extend(sp.get("key") for sp in results)
+            start += 25
+            if len(results) < 25:
+                break
+        return keys[:max_spaces]
+
+    @task
+    def begin_bulk_load():
+        load_app_env()
+        import confluence_ingest
+
+        confluence_ingest.begin_bulk_load()
+
+    @task(pool=CONFLUENCE_POOL)
+    def ingest_space(space_key):
+        load_app_env()
+        import confluence_ingest
+
+        confluence_ingest.ingest_space_by_key(space_key, max_pages=200)
+
+    @task(trigger_rule="all_done")
+    def end_bulk_load():
+        load_app_env()
+        import confluence_ingest
+
+        confluence_ingest.end_bulk_load()
+
+    @task(pool=CONFLUENCE_POOL)
+    def sync_space(space_key):
+        load_app_env()
+        import confluence_sync
+
+        confluence_sync.ensure_index()
+        confluence_sync.sync_space_by_key(space_key)
+
+    @task
+    def advance_watermark(dag_run=None):
+        """Move the global watermark to the start of this run once every space has synced."""
+        load_app_env()
+        import confluence_sync
+
+        started = dag_run.start_date.astimezone(timezone.utc).replace(tzinfo=None)
+        confluence_sync.save_last_sync(ts=started)
+
+    # ingest and sync write the same {page_id}-{i} documents, so run them one after
+    # the other per space; sync's re-index of recently changed pages then wins
+    @task_group
+    def process_space(space_key):
+        ingest_space(space_key) >> sync_space(space_key)
+
+    spaces = list_spaces()
+    begin = begin_bulk_load()
+    processed = process_space.expand(space_key=spaces)
+    end = end_bulk_load()
+    begin >> processed >> end
+    [processed, end] >> advance_watermark()
@@ -10,220 +10,245 @@ Requires environment variables:
 - CONFLUENCE_PAT
 - OPENAI_API_KEY
 - OPENSEARCH_HOST (optional)
+- EMBED_BACKEND / EMBED_ONNX_FILE, IMAGE_CACHE_DB (optional, see embedding.py / confluence_common.py)
 
 Run: python confluence_sync.py
 """
-import os, requests, json, datetime, time
+import datetime
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
-from opensearchpy import OpenSearch
-from sentence_transformers import SentenceTransformer
-import openai
+from opensearchpy import NotFoundError
 
-# --- ENV VARS ---
-CONFLUENCE_BASE_RAW = os.getenv("CONFLUENCE_BASE", "").strip()
-CONFLUENCE_PAT = os.getenv("CONFLUENCE_PAT")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENSEARCH = os.getenv("OPENSEARCH_HOST", "http://localhost:9200")
+from confluence_common import (
+    CONFLUENCE_BASE, MAX_WORKERS, SESSION, headers, os_client,
+    describe_images, ensure_index, fetch_attachments_for_page, fetch_spaces, html_to_text,
+    index_chunks, is_image_attachment, process_page,
+)
+from embedding import INDEX
 
-if not CONFLUENCE_BASE_RAW:
-    raise SystemExit("CONFLUENCE_BASE env var required")
-CONFLUENCE_BASE = CONFLUENCE_BASE_RAW.rstrip("/")
-
-if not CONFLUENCE_PAT:
-    raise SystemExit("CONFLUENCE_PAT env var required")
-
-headers = {"Authorization": f"Bearer {CONFLUENCE_PAT}", "Accept": "application/json"}
-openai.api_key = OPENAI_API_KEY
-
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-os_client = OpenSearch(OPENSEARCH)
-INDEX = "confluence"
-SYNC_FILE = "last_sync.json"
+# watermarks live in OpenSearch so they survive ephemeral containers/workers
+SYNC_INDEX = "sync_state"
+SYNC_STATE_ID = "confluence"
+CQL_SLACK = datetime.timedelta(days=1)
+# lastUpdated is not part of the plain "history" expansion; without it every edit looks unchanged
+PAGE_EXPAND = "body.storage,history,history.lastUpdated,version,space"
 
 
 # --- SYNC TIME MANAGEMENT ---
-def get_last_sync():
-    if not os.path.exists(SYNC_FILE):
-        print("⚠️ No last_sync.json found — assuming fresh ingest already done.")
-        print("Initializing last_sync.json with current time...")
-        save_last_sync()   # write current UTC timestamp
-        return datetime.datetime.utcnow()
-    with open(SYNC_FILE, "r") as f:
-        return datetime.datetime.fromisoformat(json.load(f)["last_sync"])
-
-def save_last_sync():
-    with open(SYNC_FILE, "w") as f:
-        json.dump({"last_sync": datetime.datetime.utcnow().isoformat()}, f)
+def _read_sync_state(doc_id):
+    try:
+        doc = os_client.get(index=SYNC_INDEX, id=doc_id)
+    except NotFoundError:
+        return None
+    return datetime.datetime.fromisoformat(doc["_source"]["last_sync"])
+
+
+def get_last_sync(space_key=None):
+    """Per-space watermark, falling back to the global one; initialized to now on first run."""
+    if space_key:
+        since = _read_sync_state(f"{SYNC_STATE_ID}:{space_key}")
+        if since:
+            return since
+    since = _read_sync_state(SYNC_STATE_ID)
+    if since is None:
+        print("⚠️ No sync watermark found — assuming fresh ingest already done.")
+        print("Initializing sync watermark with current time...")
+        since = datetime.datetime.utcnow()
+        save_last_sync(ts=since)
+    return since
+
+
+def save_last_sync(space_key=None, ts=None):
+    doc_id = f"{SYNC_STATE_ID}:{space_key}" if space_key else SYNC_STATE_ID
+    ts = ts or datetime.datetime.utcnow()
+    os_client.index(index=SYNC_INDEX, id=doc_id, body={"last_sync": ts.isoformat()}, refresh=True)
+
+
+def changed_since(timestamp, since, since_iso):
+    """Whether a Confluence history timestamp is newer than the naive-UTC watermark."""
+    if not timestamp:
+        return False
+    # UTC "Z" timestamps order lexicographically, so skip parsing the common case
+    if timestamp.endswith("Z"):
+        return timestamp[:-1] > since_iso
+    # Server/Data Center report local offsets (e.g. +02:00); normalize to naive UTC
+    ts = datetime.datetime.fromisoformat(timestamp)
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts > since
 
 
 # --- FETCH HELPERS ---
-def fetch_spaces(limit=50, start=0):
-    url = f"{CONFLUENCE_BASE}/rest/api/space"
-    params = {"limit": limit, "start": start}
-    r = requests.get(url, headers=headers, params=params, timeout=30)
+def search_content(cql, expand, limit=25, start=0):
+    url = f"{CONFLUENCE_BASE}/rest/api/content/search"
+    params = {"cql": cql, "limit": limit, "start": start, "expand": expand}
+    r = SESSION.get(url, headers=headers, params=params, timeout=30)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def fetch_pages_in_space(space_key, limit=25, start=0):
-    url = f"{CONFLUENCE_BASE}/rest/api/content"
-    params = {"spaceKey": space_key, "limit": limit, "start": start, "expand": "body.storage,history"}
-    r = requests.get(url, headers=headers, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
-
-
-def fetch_attachments_for_page(page_id, limit=50):
-    url = f"{CONFLUENCE_BASE}/rest/api/content/{page_id}/child/attachment"
-    params = {"limit": limit, "expand": "history"}
-    r = requests.get(url, headers=headers, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json().get("results", [])
+def search_all_content(cql, expand):
+    start = 0
+    while True:
+        res = search_content(cql, expand, limit=25, start=start)
+        results = res.get("results", [])
+        yield from results
+        start += 25
+        if len(results) < 25:
+            break
 
 
-def fetch_new_comments_for_page(page_id, since, limit=50):
+def fetch_new_comments_for_page(page_id, since, since_iso, limit=50):
     url = f"{CONFLUENCE_BASE}/rest/api/content/{page_id}/child/comment"
     params = {"limit": limit, "expand": "body.storage,history"}
-    r = requests.get(url, headers=headers, params=params, timeout=30)
+    r = SESSION.get(url, headers=headers, params=params, timeout=30)
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     new_comments = []
     for c in data.get("results", []):
         created_date = c.get("history", {}).get("createdDate")
-        if created_date and datetime.datetime.fromisoformat(created_date.replace("Z", "")) > since:
+        if changed_since(created_date, since, since_iso):
             body = c.get("body", {}).get("storage", {}).get("value", "")
-            soup = BeautifulSoup(body, "html.parser")
-            new_comments.append(soup.get_text(" ", strip=True))
+            new_comments.append(html_to_text(body))
     return new_comments
 
 
-# --- IMAGE DESCRIPTION ---
-def describe_image_via_openai(image_url):
-    if not OPENAI_API_KEY:
-        return "[openai key not set — image not described]"
-    try:
-        resp = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Describe this image in detail, including objects, text, charts, and labels."},
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]
-            }]
-        )
-        return resp.choices[0].message.content.strip()
-    except Exception as e:
-        return f"[image description failed: {str(e)}]"
-
-
 # --- OPENSEARCH UPDATERS ---
-def ingest_page(page):
-    """Index or re-index a full page (title + body)."""
-    page_id = page.get("id")
-    title = page.get("title")
-    url = urljoin(CONFLUENCE_BASE + "/", page.get("_links", {}).get("webui", "").lstrip("/"))
-    html = page.get("body", {}).get("storage", {}).get("value", "")
-    soup = BeautifulSoup(html or "", "html.parser")
-    text = soup.get_text(" ", strip=True)
-    chunks = [text[i:i+1500] for i in range(0, len(text), 1500)] or [""]
-    for i, ch in enumerate(chunks):
-        emb = embed_model.encode(ch).tolist()
-        doc = {
-            "title": title,
-            "url": url,
-            "text": ch,
-            "metadata": {"space": page.get("space", {}).get("key"), "page_id": page_id, "chunk": i},
-            "embedding": emb,
-        }
-        os_client.index(index=INDEX, id=f"{page_id}-{i}", body=doc)
+def _update_page_doc(page_id, body):
+    try:
+        os_client.update(index=INDEX, id=f"{page_id}-0", body=body)  # assume chunk 0 holds metadata
+    except NotFoundError:
+        # the page was never indexed (e.g. beyond ingest's max_pages); nothing to append to
+        print(f"Page {page_id} is not indexed, skipping attachment/comment update")
 
 
 def update_page_attachments_in_opensearch(page_id, new_attachments):
     if not new_attachments:
         return
-    os_client.update(
-        index=INDEX,
-        id=f"{page_id}-0",  # assume chunk 0 holds metadata
-        body={
-            "script": {
-                "source": "ctx._source.images.addAll(params.new_images)",
-                "lang": "painless",
-                "params": {"new_images": new_attachments},
-            }
-        },
-    )
+    _update_page_doc(page_id, {
+        "script": {
+            "source": "if (ctx._source.images == null) { ctx._source.images = []; } ctx._source.images.addAll(params.new_images)",
+            "lang": "painless",
+            "params": {"new_images": new_attachments},
+        }
+    })
 
 
 def update_page_comments_in_opensearch(page_id, new_comments):
     if not new_comments:
         return
-    os_client.update(
-        index=INDEX,
-        id=f"{page_id}-0",  # assume chunk 0 holds metadata
-        body={
-            "script": {
-                "source": "ctx._source.comments.addAll(params.new_comments)",
-                "lang": "painless",
-                "params": {"new_comments": new_comments},
-            }
-        },
-    )
+    _update_page_doc(page_id, {
+        "script": {
+            "source": "if (ctx._source.comments == null) { ctx._source.comments = []; } ctx._source.comments.addAll(params.new_comments)",
+            "lang": "painless",
+            "params": {"new_comments": new_comments},
+        }
+    })
 
 
 # --- MAIN INCREMENTAL SYNC ---
+def page_change(page, since, since_iso):
+    """"new", "updated" or None for a page fetched with PAGE_EXPAND.
+
+    >>> since = datetime.datetime(2025, 1, 10)
+    >>> edited = {"history": {"createdDate": "2025-01-01T09:00:00.000Z",
+    ...                       "lastUpdated": {"when": "2025-01-11T09:00:00.000Z"}}}
+    >>> page_change(edited, since, since.isoformat())
+    'updated'
+    >>> page_change({"history": {"createdDate": "2025-01-01T09:00:00.000Z"},
+    ...              "version": {"when": "2025-01-11T11:00:00.000+02:00"}}, since, since.isoformat())
+    'updated'
+    >>> page_change({"history": {"createdDate": "2025-01-11T09:00:00.000Z"}}, since, since.isoformat())
+    'new'
+    >>> page_change({"history": edited["history"] | {"lastUpdated": {"when": "2025-01-09T09:00:00.000Z"}}},
+    ...             since, since.isoformat()) is None
+    True
+    """
+    history = page.get("history", {})
+    if changed_since(history.get("createdDate"), since, since_iso):
+        return "new"
+    updated = history.get("lastUpdated", {}).get("when") or page.get("version", {}).get("when")
+    if changed_since(updated, since, since_iso):
+        return "updated"
+    return None
+
+
+def sync_page(page, space_key, since, since_iso):
+    """Chunks to re-index if the page was created or updated since the last sync, else []."""
+    change = page_change(page, since, since_iso)
+    if change is None:
+        return []
+    print(f"{change.capitalize()} page {page['title']}")
+    return process_page(page, space_key)
+
+
+def sync_page_children(page_id, since, since_iso):
+    """Push attachments and comments added to the page since the last sync."""
+    # --- New attachments ---
+    urls = []
+    attachments = fetch_attachments_for_page(page_id)
+    for a in attachments:
+        cdate = a.get("history", {}).get("createdDate")
+        if changed_since(cdate, since, since_iso):
+            rel = a.get("_links", {}).get("download")
+            if rel and is_image_attachment(a):
+                urls.append(urljoin(CONFLUENCE_BASE + "/", rel.lstrip("/")))
+    new_attachments = [{"url": u, "description": d} for u, d in zip(urls, describe_images(urls)) if d is not None]
+    if new_attachments:
+        update_page_attachments_in_opensearch(page_id, new_attachments)
+
+    # --- New comments ---
+    new_comments = fetch_new_comments_for_page(page_id, since, since_iso)
+    if new_comments:
+        update_page_comments_in_opensearch(page_id, new_comments)
+
+
 def incremental_sync_space(space_key, since):
     print(f"Incremental sync for space {space_key} since {since}")
-    start = 0
-    while True:
-        res = fetch_pages_in_space(space_key, limit=25, start=start)
-        results = res.get("results", [])
-        if not results:
-            break
+    # CQL dates are minute-precision in the server's timezone, so query a wider
+    # window and let the exact history timestamps decide what actually changed
+    cql_since = (since - CQL_SLACK).strftime("%Y-%m-%d %H:%M")
+    # string form of the watermark for changed_since()'s "Z" fast path
+    since_iso = since.isoformat()
+
+    # --- New or updated pages ---
+    pages = list(search_all_content(
+        f'space="{space_key}" and type=page and lastModified > "{cql_since}"',
+        expand=PAGE_EXPAND,
+    ))
+
+    # --- Pages that gained attachments or comments ---
+    children = search_all_content(
+        f'space="{space_key}" and type in (attachment, comment) and created > "{cql_since}"',
+        expand="container",
+    )
+    touched = {c["container"]["id"] for c in children if c.get("container", {}).get("id")}
 
-        for page in results:
-            page_id = page.get("id")
-            history = page.get("history", {})
-            created = history.get("createdDate")
-            updated = history.get("lastUpdated", {}).get("when")
-            created_dt = datetime.datetime.fromisoformat(created.replace("Z", "")) if created else None
-            updated_dt = datetime.datetime.fromisoformat(updated.replace("Z", "")) if updated else None
-
-            # --- New or updated page ---
-            if created_dt and created_dt > since:
-                print(f"New page {page['title']}")
-                ingest_page(page)
-            elif updated_dt and updated_dt > since:
-                print(f"Updated page {page['title']}")
-                ingest_page(page)
-
-            # --- New attachments ---
-            new_attachments = []
-            attachments = fetch_attachments_for_page(page_id)
-            for a in attachments:
-                cdate = a.get("history", {}).get("createdDate")
-                if cdate and datetime.datetime.fromisoformat(cdate.replace("Z", "")) > since:
-                    rel = a.get("_links", {}).get("download")
-                    if rel:
-                        full = urljoin(CONFLUENCE_BASE + "/", rel.lstrip("/"))
-                        desc = describe_image_via_openai(full)
-                        new_attachments.append({"url": full, "description": desc})
-                        time.sleep(0.2)
-            if new_attachments:
-                update_page_attachments_in_opensearch(page_id, new_attachments)
-
-            # --- New comments ---
-            new_comments = fetch_new_comments_for_page(page_id, since)
-            if new_comments:
-                update_page_comments_in_opensearch(page_id, new_comments)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # workers only fetch and chunk; embedding runs on this thread below
+        page_items = list(executor.map(lambda p: sync_page(p, space_key, since, since_iso), pages))
+        failed = index_chunks([item for items in page_items for item in items])
+        if failed:
+            # sync_space_by_key must not advance the watermark past pages that were not written
+            raise RuntimeError(f"{len(failed)} chunk(s) failed to index in space {space_key}")
+        # re-indexed pages already carry all of their attachments and comments
+        reindexed = {p.get("id") for p, items in zip(pages, page_items) if items}
+        # drain the iterator so worker exceptions surface here
+        list(executor.map(lambda pid: sync_page_children(pid, since, since_iso), touched - reindexed))
 
-        start += 25
-        if len(results) < 25:
-            break
+
+def sync_space_by_key(space_key):
+    """Sync one space against its own watermark and advance it."""
+    started = datetime.datetime.utcnow()
+    incremental_sync_space(space_key, get_last_sync(space_key))
+    save_last_sync(space_key, ts=started)
 
 
 def incremental_sync_all_spaces(max_spaces=50):
+    ensure_index()
+    # watermark the start of the run so edits made while syncing are picked up next time
+    started = datetime.datetime.utcnow()
     since = get_last_sync()
     print(f"Starting incremental sync for all spaces since {since}")
     start = 0
@@ -236,14 +261,14 @@ def incremental_sync_all_spaces(max_spaces=50):
         for sp in results:
             key = sp.get("key")
             print(f"-> Syncing space {key} ({sp.get('name')})")
-            incremental_sync_space(key, since)
+            sync_space_by_key(key)
             seen += 1
             if seen >= max_spaces:
                 break
         start += 25
         if len(results) < 25:
             break
-    save_last_sync()
+    save_last_sync(ts=started)
     print("Finished incremental sync of all spaces.")
 
 
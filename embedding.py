@@ -0,0 +1,175 @@
+"""
+Embedding model, chunking, quantization and the OpenSearch index mapping shared by
+confluence_ingest.py, confluence_sync.py and qa_service.py, so the vectors written at
+ingest time and the ones queried at search time cannot drift apart.
+
+Optional environment variables:
+- EMBED_BACKEND / EMBED_ONNX_FILE (default int8 ONNX Runtime on every host; "torch" uses
+  fp16 CUDA where available). Writers and qa_service must use the same backend.
+"""
+import os, copy, hashlib, threading
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+# "onnx" runs the int8-quantized ONNX export on ONNX Runtime; "torch" keeps plain PyTorch
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx")
+EMBED_ONNX_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+CHUNK_OVERLAP = 32  # tokens shared between consecutive chunks
+
+INDEX = "confluence"
+REFRESH_INTERVAL = "30s"
+
+INDEX_BODY = {
+    "settings": {
+        "index": {
+            "knn": True,
+            "refresh_interval": REFRESH_INTERVAL,
+            "translog.flush_threshold_size": "1gb",
+            "number_of_replicas": 1,
+        }
+    },
+    "mappings": {
+        "properties": {
+            "title": {"type": "text"},
+            "url": {"type": "keyword"},
+            "text": {"type": "text"},
+            "metadata": {
+                "properties": {
+                    "space": {"type": "keyword"},
+                    "page_id": {"type": "keyword"},
+                    "chunk": {"type": "integer"},
+                }
+            },
+            "embedding": {
+                "type": "knn_vector",
+                "dimension": 384,
+                "data_type": "byte",
+                "method": {
+                    "name": "hnsw",
+                    "engine": "lucene",
+                    "space_type": "l2",
+                    "parameters": {"m": 16, "ef_construction": 100},
+                },
+            },
+            "images": {
+                "properties": {
+                    "url": {"type": "keyword"},
+                    "description": {"type": "text"},
+                }
+            },
+            "comments": {"type": "text"},
+        }
+    },
+}
+
+# containerized CPUs report the host core count; cap intra-op threads and skip autograd
+EMBED_THREADS = min(8, os.cpu_count() or 1)
+torch.set_num_threads(EMBED_THREADS)
+torch.set_num_interop_threads(1)
+torch.set_grad_enabled(False)
+
+# only the torch backend moves to the GPU; the ONNX graph is the same everywhere, so a GPU
+# ingest worker and a CPU QA container still produce vectors from identical weights
+EMBED_DEVICE = "cuda" if EMBED_BACKEND == "torch" and torch.cuda.is_available() else "cpu"
+EMBED_BATCH_SIZE = 256 if EMBED_DEVICE == "cuda" else 64
+
+# loaded on first use, so importing this module (e.g. from an Airflow bookkeeping task) stays cheap
+_model_lock = threading.Lock()
+_embed_model = None
+_chunk_tokenizer = None
+_chunk_lock = threading.Lock()
+
+
+def _load_model():
+    if EMBED_BACKEND == "onnx":
+        import onnxruntime
+
+        # ONNX Runtime has its own thread pools and ignores the torch settings above
+        ort_options = onnxruntime.SessionOptions()
+        ort_options.intra_op_num_threads = EMBED_THREADS
+        ort_options.inter_op_num_threads = 1
+        model = SentenceTransformer(
+            "all-MiniLM-L6-v2",
+            backend="onnx",
+            model_kwargs={"file_name": EMBED_ONNX_FILE, "provider": "CPUExecutionProvider", "session_options": ort_options},
+        )
+    else:
+        model = SentenceTransformer("all-MiniLM-L6-v2", backend=EMBED_BACKEND, device=EMBED_DEVICE)
+        if EMBED_DEVICE == "cuda":
+            model.half()
+    model.eval()
+    return model
+
+
+def get_embed_model():
+    global _embed_model, _chunk_tokenizer
+    if _embed_model is None:
+        with _model_lock:
+            if _embed_model is None:
+                model = _load_model()
+                # dedicated tokenizer for chunking so worker threads never contend with encode()
+                _chunk_tokenizer = copy.deepcopy(model.tokenizer)
+                _embed_model = model
+    return _embed_model
+
+
+# per-run dedup of repeated boilerplate chunks
+_dedup_lock = threading.Lock()
+_chunk_emb_cache = {}
+
+
+def chunk_text(text):
+    """Split text into overlapping windows that fit the model's max sequence length."""
+    model = get_embed_model()
+    with _chunk_lock:
+        enc = _chunk_tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    offsets = enc["offset_mapping"]
+    if not offsets:
+        return [""]
+    size = model.max_seq_length - 2  # room for [CLS]/[SEP]
+    step = size - CHUNK_OVERLAP
+    # slice the original text by character offsets so chunks keep their casing/spacing
+    return [
+        text[offsets[i][0]:offsets[min(i + size, len(offsets)) - 1][1]]
+        for i in range(0, max(len(offsets) - CHUNK_OVERLAP, 1), step)
+    ]
+
+
+def quantize_embeddings(embs):
+    """Map unit-norm float vectors onto int8 for the byte knn_vector field."""
+    return np.clip(np.round(embs.astype(np.float32) * 127), -128, 127).astype(np.int8)
+
+
+def embed_chunks(chunks):
+    """Embed chunks, reusing vectors for text already embedded during this run."""
+    keys = [hashlib.sha1(c.encode()).hexdigest() for c in chunks]
+    with _dedup_lock:
+        unseen = {k: c for k, c in zip(keys, chunks) if k not in _chunk_emb_cache}
+    if unseen:
+        new_keys, new_chunks = list(unseen), list(unseen.values())
+        # length-sort so each mini-batch pads minimally
+        order = np.argsort([len(c) for c in new_chunks], kind="stable")
+        # grad mode is thread-local and this runs on worker threads too
+        with torch.inference_mode():
+            embs = get_embed_model().encode(
+                [new_chunks[i] for i in order],
+                batch_size=EMBED_BATCH_SIZE,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+        embs = quantize_embeddings(embs)
+        with _dedup_lock:
+            for i, emb in zip(order, embs):
+                _chunk_emb_cache[new_keys[i]] = emb
+    with _dedup_lock:
+        return np.stack([_chunk_emb_cache[k] for k in keys])
+
+
+def embed_query(query):
+    """Quantized query vector, encoded exactly like the indexed chunks."""
+    # grad mode is thread-local, so don't rely on the module-level switch here
+    with torch.inference_mode():
+        emb = get_embed_model().encode(query, normalize_embeddings=True, convert_to_numpy=True)
+    return quantize_embeddings(emb)
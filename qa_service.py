@@ -1,19 +1,29 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from fastapi import FastAPI, Query
 from pydantic import BaseModel
-from opensearchpy import OpenSearch
-from sentence_transformers import SentenceTransformer
+from opensearchpy import OpenSearch, RequestsHttpConnection
 import openai
 
+import embedding
+from embedding import INDEX
+
 # --- ENV ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENSEARCH = os.getenv("OPENSEARCH_HOST", "http://localhost:9200")
-INDEX = "confluence"
 
 # --- Clients ---
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-os_client = OpenSearch(OPENSEARCH)
-openai.api_key = OPENAI_API_KEY
+# pooled keep-alive connections sized for uvicorn's request threadpool
+os_client = OpenSearch(
+    OPENSEARCH,
+    http_compress=True,
+    connection_class=RequestsHttpConnection,
+    pool_maxsize=32,
+)
+openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# single long-lived inference thread keeps the model and torch's thread pools warm
+embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
 
 app = FastAPI(title="Confluence Q&A Service")
 
@@ -23,21 +33,20 @@ class QAResponse(BaseModel):
     sources: list[str]
 
 # --- Search ---
+@lru_cache(maxsize=1024)
+def embed_query(query):
+    return tuple(embedding.embed_query(query).tolist())
+
+# warm up off the import path so the first request doesn't pay for lazy init
+embed_executor.submit(embed_query, "warm up")
+
 def search_opensearch(query, top_k=5):
-    emb = embed_model.encode(query).tolist()
+    emb = list(embed_executor.submit(embed_query, query).result())
     resp = os_client.search(
         index=INDEX,
         body={
             "size": top_k,
-            "query": {
-                "script_score": {
-                    "query": {"match_all": {}},
-                    "script": {
-                        "source": "cosineSimilarity(params.query_vector, 'embedding') + 1.0",
-                        "params": {"query_vector": emb}
-                    }
-                }
-            }
+            "query": {"knn": {"embedding": {"vector": emb, "k": top_k}}},
         }
     )
     hits = resp["hits"]["hits"]
@@ -57,7 +66,7 @@ def ask_llm(question, docs):
         {"role": "system", "content": "You are a helpful assistant answering questions based on Confluence knowledge."},
         {"role": "user", "content": f"Question: {question}\n\nContext:\n{context}\n\nAnswer with references [1], [2], etc."}
     ]
-    resp = openai.chat.completions.create(
+    resp = openai_client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
     )